@@ -19,17 +19,39 @@ Elements of FoundationPlist.py are used in this tool.
 https://github.com/munki/munki
 """
 
+import Queue
 import argparse
 import collections
+import errno
+import fcntl
+import filecmp
+import hashlib
+import httplib
 import os
 import shutil
 import signal
+import socket
+import stat
+import struct
 import sys
+import threading
 import urllib2
+import zlib
 from glob import glob
 from random import uniform
-from time import sleep
+from time import sleep, time
 from urlparse import urlparse
+from xml.etree import ElementTree
+
+# scandir is a lot quicker than listdir for walking a large download tree, so
+# use it if it is available (either built in, or the backport).
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # PyLint cannot properly find names inside Cocoa libraries, so issues bogus
 # No name 'Foo' in module 'Bar' warnings. Disable them.
@@ -83,19 +105,163 @@ def readPlistFromString(data):
         return dataObject
 
 
+class DownloadError(Exception):
+    """A request failed and retrying it didn't help"""
+    pass
+
+
+class PermanentError(DownloadError):
+    """A request failed in a way that retrying won't fix, such as a 404"""
+    pass
+
+
+class CircuitOpenError(DownloadError):
+    """Requests to a host are paused after repeated failures"""
+    pass
+
+
+class StallError(Exception):
+    """A transfer slowed down below the minimum speed"""
+    pass
+
+
+class XarError(Exception):
+    """A package isn't a readable xar archive"""
+    pass
+
+
+class DiskSpaceError(Exception):
+    """Not enough free space for the download"""
+    pass
+
+
+def preallocate(output, offset, length):
+    """Reserves length bytes of disk space for a file from the offset. This
+    keeps the file in one piece on disk, and means running out of space is
+    found straight away rather than part way through a download. Raises
+    DiskSpaceError if there isn't enough space. Filesystems that don't
+    support preallocating are ignored."""
+    try:
+        if sys.platform == 'darwin':
+            # fcntl F_PREALLOCATE takes an fstore_t struct. Ask for contiguous
+            # space first, then settle for any space. F_PEOFPOSMODE allocates
+            # from the end of the file, so the offset is 0.
+            F_PREALLOCATE = 42
+            F_ALLOCATECONTIG = 0x2
+            F_ALLOCATEALL = 0x4
+            F_PEOFPOSMODE = 3
+            try:
+                fcntl.fcntl(output.fileno(), F_PREALLOCATE, struct.pack(
+                    'Iiqqq', F_ALLOCATECONTIG | F_ALLOCATEALL, F_PEOFPOSMODE,
+                    0, length, 0))
+            except IOError:
+                fcntl.fcntl(output.fileno(), F_PREALLOCATE, struct.pack(
+                    'Iiqqq', F_ALLOCATEALL, F_PEOFPOSMODE, 0, length, 0))
+        elif hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(output.fileno(), offset, length)
+    except EnvironmentError as e:
+        if e.errno == errno.ENOSPC:
+            raise DiskSpaceError('Not enough space for %s (%s bytes)' % (
+                output.name, length))
+
+
+class FileSink():
+    """A destination for a download. Data is written into a .part file next to
+    the destination, which is renamed into place once the download is
+    complete. A single download can be written to several sinks at once.
+    If the size is given, space for the file is preallocated. The ETag or
+    Last-Modified date of the package being downloaded is saved next to the
+    partial file, so it is only resumed from the same version."""
+    def __init__(self, path, size=None):
+        self.path = path
+        self.size_expected = size
+        self.partial_path = '%s.part' % path
+        self.validator_path = '%s.validator' % self.partial_path
+        self.output = None
+        self.error = None
+
+    def size(self):
+        """Returns the size of the partial file, 0 if there isn't one."""
+        try:
+            return os.path.getsize(self.partial_path)
+        except OSError:
+            return 0
+
+    def validator(self):
+        """Returns the validator saved with the partial file, or None if there
+        isn't one."""
+        try:
+            with open(self.validator_path) as saved:
+                return saved.read().strip() or None
+        except IOError:
+            return None
+
+    def open(self, offset, validator=None):
+        """Opens the partial file, ready to write from the offset, and saves
+        the validator of the package being written to it. Without a
+        validator, the partial file won't be resumed."""
+        if offset:
+            self.output = open(self.partial_path, 'r+b')
+            self.output.truncate(offset)
+            self.output.seek(offset)
+        else:
+            self.output = open(self.partial_path, 'wb')
+
+        if validator:
+            with open(self.validator_path, 'w') as saved:
+                saved.write(validator)
+        else:
+            self.remove_validator()
+
+        if self.size_expected and self.size_expected > offset:
+            preallocate(self.output, offset, self.size_expected - offset)
+
+    def write(self, data):
+        self.output.write(data)
+        # self.output.flush()
+        os.fsync(self.output)
+
+    def close(self):
+        if self.output:
+            self.output.close()
+            self.output = None
+
+    def commit(self):
+        """Renames the completed partial file into place."""
+        self.close()
+        os.rename(self.partial_path, self.path)
+        self.remove_validator()
+
+    def remove_validator(self):
+        try:
+            os.unlink(self.validator_path)
+        except OSError:
+            pass
+
+
 class AppleLoops():
     """Class contains functions for parsing Apple's plist feeds for GarageBand
     and Logic Pro, as well as downloading loops content."""
     def __init__(self, download_location=None, dry_run=True,
                  package_set=None, package_year=None,
                  mandatory_pkg=False, optional_pkg=False,
-                 caching_server=None, files_process=None, jss_mode=False):
+                 caching_server=None, files_process=None, jss_mode=False,
+                 retries=3, retry_backoff=2, connect_timeout=30,
+                 read_timeout=60, stall_speed=10240, stall_window=60,
+                 mirror_locations=None, space_check=True):
         try:
             if not download_location:
                 self.download_location = os.path.join('/tmp', 'appleLoops')
             else:
                 self.download_location = download_location
 
+            # Additional locations that get a copy of everything downloaded,
+            # laid out the same way as the download location
+            if mirror_locations:
+                self.mirror_locations = mirror_locations
+            else:
+                self.mirror_locations = []
+
             # Default to dry run
             self.dry_run = dry_run
 
@@ -143,6 +309,76 @@ class AppleLoops():
             else:
                 self.jss_mode = False
 
+            # Retry policy for requests. Each request is attempted up to
+            # retries + 1 times, with an exponential backoff (and a bit of
+            # jitter) between each attempt.
+            self.retries = retries
+            self.retry_backoff = retry_backoff
+            self.retry_backoff_max = 60
+
+            # Per host circuit breaker. After a run of consecutive failures
+            # from a host (Apple's servers or a caching server), stop sending
+            # requests to it until the cooldown has passed.
+            self.circuit_threshold = 5
+            self.circuit_cooldown = 300
+            self.circuit_failures = {}
+            self.circuit_opened = {}
+            self.circuit_lock = threading.Lock()
+
+            # Timeouts (in seconds) for connecting to a server, and for each
+            # read from the connection once it's open.
+            self.connect_timeout = connect_timeout
+            self.read_timeout = read_timeout
+
+            # A transfer that averages less than stall_speed bytes a second
+            # over stall_window seconds is treated as stalled, and is aborted
+            # so it can be retried.
+            self.stall_speed = stall_speed
+            self.stall_window = stall_window
+
+            # Check there is enough free space before downloading. The space
+            # needed is added up per filesystem as loops are worked out.
+            self.space_check = space_check
+            self.space = collections.OrderedDict()
+            self.space_devices = {}
+            self.space_counted = set()
+
+            # Loops are downloaded while later ones are still being worked
+            # out. This is how many worked out loops can be waiting.
+            self.queue_size = 16
+            self.planning = False
+            self.planning_error = None
+
+            # Lock files let several runs of this tool share the same download
+            # location without fetching the same package at the same time. A
+            # lock that hasn't been refreshed within the lease is assumed to
+            # be left behind by a run that died.
+            self.lock_location = os.path.join(self.download_location, '.locks')
+            self.lock_lease = 600
+            self.lock_refresh = 60
+            self.lock_poll = 5
+            self.lock_refreshed = 0
+            self.held_locks = {}
+
+            # Check the size of each package with the server when building the
+            # master list. Garbage collection doesn't need it, so turns it off.
+            self.probe_sizes = True
+
+            # Packages that failed to download, along with their counter.
+            # These get another go at the end of the run.
+            self.retry_queue = []
+
+            # Packages that can't be downloaded, such as ones the server
+            # doesn't have. Retrying these won't help.
+            self.failed = []
+
+            # Feeds that couldn't be fetched
+            self.failed_feeds = []
+
+            # Each feed that has been read, by URL, so it is only fetched
+            # once. None if it couldn't be fetched.
+            self.feed_data = {}
+
             # User-Agent string for this tool
             self.user_agent = 'appleLoops/%s' % __version__
 
@@ -217,20 +453,196 @@ class AppleLoops():
 
     # Wrap around urllib2 for requesting URL's because this is done often
     # enough
-    def request_url(self, url):
+    def open_url(self, url, headers=None):
+        """Makes a single request for the URL, errors are left to the caller
+        to handle."""
         try:
             req = urllib2.Request(url)
             req.add_unredirected_header('User-Agent', self.user_agent)
-            req = urllib2.urlopen(req)
+            if headers:
+                for header, value in headers.items():
+                    req.add_header(header, value)
+            req = urllib2.urlopen(req, timeout=self.connect_timeout)
+            self.set_read_timeout(req)
             return req
         except (KeyboardInterrupt, SystemExit):
             self.exit_out()
 
-    def add_loop(self, package_name, package_url,
-                 package_mandatory, package_size,
-                 package_year, loop_for, plist):
-        """Add's the loop to the master list. A named tuple is used to make
-        referencing attributes of each loop easier."""
+    def set_read_timeout(self, response):
+        """urllib2 only has the one timeout, used for connecting and reading,
+        so dig the socket out of the response and give it the read timeout."""
+        try:
+            response.fp._sock.fp._sock.settimeout(self.read_timeout)
+        except AttributeError:
+            pass
+
+    def request_url(self, url):
+        """Requests the URL, retrying if the request fails."""
+        try:
+            return self.retry_request(url, self.open_url)
+        except (KeyboardInterrupt, SystemExit):
+            self.exit_out()
+
+    def source_urls(self, loop):
+        """Returns the URLs a loop can be downloaded from. When a caching
+        server is used, Apple's server is the alternate source if the caching
+        server fails."""
+        urls = [loop.pkg_url]
+        if self.caching_server and loop.pkg_url.startswith(
+                self.cache_base_url):
+            origin_url = loop.pkg_url.replace(self.cache_base_url,
+                                              self.base_url, 1)
+            if origin_url.endswith(self.source_url):
+                origin_url = origin_url[:-len(self.source_url)]
+            urls.append(origin_url)
+        return urls
+
+    # Circuit breaker for each host that requests are made to
+    def circuit_is_open(self, host):
+        """Tests if requests to the host are paused. Once the cooldown has
+        passed the circuit is half open, so a request is let through to see if
+        the host has recovered, and a single failure opens it again."""
+        with self.circuit_lock:
+            opened = self.circuit_opened.get(host)
+            if opened is None:
+                return False
+            elif time() - opened >= self.circuit_cooldown:
+                del self.circuit_opened[host]
+                self.circuit_failures[host] = self.circuit_threshold - 1
+                return False
+            else:
+                return True
+
+    def circuit_failure(self, host):
+        """Counts a failure against the host, and opens the circuit if there
+        have been too many in a row."""
+        with self.circuit_lock:
+            failures = self.circuit_failures.get(host, 0) + 1
+            self.circuit_failures[host] = failures
+            if (failures >= self.circuit_threshold and
+                    host not in self.circuit_opened):
+                self.circuit_opened[host] = time()
+                print 'Too many failures from %s, pausing requests for %s ' \
+                    'seconds' % (host, self.circuit_cooldown)
+
+    def circuit_success(self, host):
+        """Closes the circuit for the host."""
+        with self.circuit_lock:
+            self.circuit_failures.pop(host, None)
+            self.circuit_opened.pop(host, None)
+
+    def circuit_wait(self, hosts):
+        """Waits until the circuit for the first of the hosts to reopen is
+        half open."""
+        with self.circuit_lock:
+            reopen = min(self.circuit_opened.get(host, 0) for host in hosts)
+        delay = max(0, reopen + self.circuit_cooldown - time())
+        print 'Requests to %s are paused, waiting %s seconds' % (
+            ', '.join(hosts), int(delay))
+        self.wait(delay)
+
+    def retry_reason(self, error):
+        """Works out if an error is worth retrying. Returns a description of
+        the error if it is, otherwise None."""
+        # HTTPError is a subclass of URLError, so it has to be tested first.
+        # Client errors (404 and friends) won't get better with a retry.
+        if isinstance(error, urllib2.HTTPError):
+            if error.code >= 500 or error.code == 429:
+                return 'HTTP error %s' % error.code
+            else:
+                return None
+        # Couldn't connect to the host
+        elif isinstance(error, urllib2.URLError):
+            return 'connect error (%s)' % error.reason
+        # Transfer slowed to a crawl
+        elif isinstance(error, StallError):
+            return 'stalled (%s)' % error
+        # Connection dropped or timed out part way through reading
+        elif isinstance(error, (socket.error, httplib.HTTPException)):
+            return 'read error (%s)' % (str(error) or
+                                        error.__class__.__name__)
+        else:
+            return None
+
+    def retry_request(self, urls, func, *args, **kwargs):
+        """Calls func(url, *args), which makes a request to the URL, and
+        retries it with an exponential backoff if it fails with a connect,
+        read, or server error. If more than one URL is given, each retry is
+        sent to the next URL in turn, skipping any whose circuit is open. If
+        the circuit for every host is open, waits for the first to half open.
+        Raises DownloadError once the retries are used up, or if the error
+        isn't worth retrying.
+
+        Requests that don't matter much can pass circuit=False, so their
+        failures don't pause other requests. They raise CircuitOpenError
+        instead of waiting for a paused host."""
+        circuit = kwargs.pop('circuit', True)
+        if isinstance(urls, basestring):
+            urls = [urls]
+        hosts = [urlparse(url).netloc for url in urls]
+
+        attempt = 0
+        index = 0
+        while True:
+            # Pick the next URL with a host that isn't paused
+            for _ in range(len(urls)):
+                url = urls[index % len(urls)]
+                host = urlparse(url).netloc
+                if not self.circuit_is_open(host):
+                    break
+                index += 1
+            else:
+                if not circuit:
+                    raise CircuitOpenError('%s - requests to %s are paused' % (
+                        url, ', '.join(hosts)))
+                self.circuit_wait(hosts)
+                continue
+
+            try:
+                result = func(url, *args)
+            except Exception as e:
+                reason = self.retry_reason(e)
+                if not reason:
+                    if isinstance(e, urllib2.HTTPError):
+                        raise PermanentError('%s - HTTP error %s' % (url,
+                                                                     e.code))
+                    raise
+
+                if circuit:
+                    self.circuit_failure(host)
+                attempt += 1
+
+                # Re-dispatch to the alternate source, if there is one
+                index += 1
+
+                if attempt > self.retries:
+                    raise DownloadError('%s - %s, gave up after %s '
+                                        'attempts' % (url, reason, attempt))
+                elif all(host in self.circuit_opened for host in hosts):
+                    # Waiting for a host to half open is backoff enough
+                    continue
+
+                # Back off exponentially, with full jitter so several clients
+                # sharing a caching server don't all retry at the same time.
+                delay = min(self.retry_backoff_max,
+                            self.retry_backoff * 2 ** (attempt - 1))
+                delay = uniform(0, delay)
+                print 'Retry %s of %s in %.1f seconds from %s: %s - %s' % (
+                    attempt, self.retries, delay,
+                    urlparse(urls[index % len(urls)]).netloc,
+                    os.path.basename(urlparse(url).path), reason
+                )
+                self.wait(delay)
+            else:
+                if circuit:
+                    self.circuit_success(host)
+                return result
+
+    def make_loop(self, package_name, package_url,
+                  package_mandatory, package_size,
+                  package_year, loop_for, plist):
+        """Makes the loop record. A named tuple is used to make referencing
+        attributes of each loop easier."""
         try:
             # Apple aren't consistent with file sizes - so if the file size
             # comes from the plist, we may need to remove characters!
@@ -250,16 +662,33 @@ class AppleLoops():
                 pkg_plist=plist
             )
 
+            return loop
+        except (KeyboardInterrupt, SystemExit):
+            self.exit_out()
+
+    def add_loop(self, package_name, package_url,
+                 package_mandatory, package_size,
+                 package_year, loop_for, plist):
+        """Add's the loop to the master list."""
+        try:
+            loop = self.make_loop(package_name, package_url,
+                                  package_mandatory, package_size,
+                                  package_year, loop_for, plist)
+
             if loop not in self.master_list:
                 self.master_list.append(loop)
         except (KeyboardInterrupt, SystemExit):
             self.exit_out()
 
-    def process_plist(self, loop_year, plist):
-        """Processes the Apple plist feed. Makes use of readPlistFromString()
-        as python's native plistlib module doesn't read binary plists, which
-        Apple has used in past releases."""
-        try:
+    def read_feed(self, loop_year, plist):
+        """Fetches the Apple plist feed and reads it into a dictionary. Makes
+        use of readPlistFromString() as python's native plistlib module
+        doesn't read binary plists, which Apple has used in past releases.
+        Each feed is only fetched once, so checking the free space before
+        downloading doesn't slow down working out the loops. Returns None if
+        the feed can't be fetched."""
+        plist_url = self.build_url(loop_year, plist)
+        if plist_url not in self.feed_data:
             if self.jss_mode:
                 _jss_mode = 'on'
             else:
@@ -268,19 +697,37 @@ class AppleLoops():
             print 'Processing items from %s and saving to %s. JSS mode %s' % (
                             plist, self.download_location, _jss_mode
                         )
+
+            # URL requests. If the feed can't be fetched, carry on with the
+            # others, and let the run fail at the end.
+            try:
+                request = self.request_url(plist_url)
+            except DownloadError as e:
+                print 'Could not fetch %s: %s' % (plist, e)
+                self.failed_feeds.append(plist)
+                self.feed_data[plist_url] = None
+            else:
+                # Process request data into dictionary
+                self.feed_data[plist_url] = readPlistFromString(
+                    request.read())
+                request.close()
+
+        return self.feed_data[plist_url]
+
+    def iter_plist(self, loop_year, plist):
+        """Generator that processes the Apple plist feed, and yields each loop
+        in it as soon as it has been worked out."""
+        try:
             # Note - the package size specified in the plist feeds doesn't
             # always match the actual package size, so check header
             # 'Content-Length' to determine correct package size.
-            plist_url = self.build_url(loop_year, plist)
+            data = self.read_feed(loop_year, plist)
+            if data is None:
+                return
 
             # Split extension from the plist for folder creation
             _plist = os.path.splitext(plist)[0]
 
-            # URL requests
-            request = self.request_url(plist_url)
-
-            # Process request data into dictionary
-            data = readPlistFromString(request.read())
             loop_for = os.path.splitext(plist)[0]
 
             # I don't like using regex, so here's a lambda to remove numbers
@@ -305,73 +752,119 @@ class AppleLoops():
                 # package name. Additionally, replace the year with the correct
                 # year
                 if name.startswith('../'):
-                    url = 'http://audiocontentdownload.apple.com/%s' % name[3:]
+                    if self.caching_server:
+                        url = '%s/%s%s' % (self.caching_server, name[3:],
+                                           self.source_url)
+                    else:
+                        url = 'http://audiocontentdownload.apple.com/%s' % (
+                            name[3:]
+                        )
                     name = os.path.basename(name)
 
                 # List comprehension to get the year
                 year = [x[-4:] for x in url.split('/') if 'lp10_ms3' in x][0]
 
                 # This step adds time to the processing of the plist
-                try:
-                    request = self.request_url(url)
-                    size = request.info().getheader('Content-Length').strip()
-
-                    # Close out the urllib2 request
-                    request.close()
-                except:
+                size = None
+                if self.probe_sizes:
+                    try:
+                        # A failed probe shouldn't pause the downloads
+                        request = self.retry_request(url, self.open_url,
+                                                     circuit=False)
+                        size = (request.info().getheader('Content-Length') or
+                                '').strip()
+
+                        # Close out the urllib2 request
+                        request.close()
+                    except DownloadError as e:
+                        print 'Using plist size for %s: %s' % (name, e)
+
+                if not size:
                     size = data['Packages'][pkg]['DownloadSize']
 
-                # Add to the loops master list
+                # Hand the loop over
                 if self.mandatory_pkg and not self.optional_pkg:
                     if mandatory:
-                        self.add_loop(name, url, mandatory, size, year,
-                                      loop_for, _plist)
+                        yield self.make_loop(name, url, mandatory, size, year,
+                                             loop_for, _plist)
                 elif self.optional_pkg and not self.mandatory_pkg:
                     if not mandatory:
-                        self.add_loop(name, url, mandatory, size, year,
-                                      loop_for, _plist)
+                        yield self.make_loop(name, url, mandatory, size, year,
+                                             loop_for, _plist)
                 else:
                     pass
 
                 if not self.mandatory_pkg and not self.optional_pkg:
-                    self.add_loop(name, url, mandatory, size, year, loop_for,
-                                  _plist)
-
-            # Tidy up the urllib2 request
-            request.close()
+                    yield self.make_loop(name, url, mandatory, size, year,
+                                         loop_for, _plist)
         except (KeyboardInterrupt, SystemExit):
             self.exit_out()
 
-    def build_master_list(self):
-        """This builds the master list of audio content so it (the master list)
-        can be processed in other functions. Yeah, there's some funky Big O
-        here."""
+    def process_plist(self, loop_year, plist):
+        """Processes the Apple plist feed, adding each loop in it to the master
+        list."""
+        try:
+            for loop in self.iter_plist(loop_year, plist):
+                self.add_loop(*loop)
+        except (KeyboardInterrupt, SystemExit):
+            self.exit_out()
 
+    def iter_loops(self):
+        """Generator that yields each loop in the package sets and years being
+        processed, as soon as it has been worked out, so the loops can be
+        worked on without waiting for every plist to be processed. Each loop
+        is only yielded once. This can be used to embed appleLoops in other
+        tools, for example:
+
+            loops = AppleLoops(package_set=['garageband'],
+                               package_year=['2016'])
+            for loop in loops.iter_loops():
+                print loop.pkg_name, loop.pkg_url
+        """
         # This is where we'll check if we're processing a specific file or not
         try:
+            seen = set()
+
             # Yo dawg, heard you like for loops, so I put for loops in your for
             # loops in your for loops
-            if self.files_process:
-                # This loops through package sets, and checks if we're only
-                # processing from a specific file, if so, just do the tango for
-                # that file.
-                for pkg_set in self.package_set:
-                    for year in self.package_year:
-                        package_plist = self.loop_feed_locations[pkg_set][year]
-                        for plist in self.files_process:
-                            if plist in package_plist:
-                                self.process_plist(year, plist)
-            else:
-                # Here we just loop through all the package sets and do the
-                # tango for everything that is defaulted to.
-                for pkg_set in self.package_set:
-                    for year in self.package_year:
-                        package_plist = self.loop_feed_locations[pkg_set][year]
-                        for plist in package_plist:
-                            self.process_plist(year, plist)
+            for pkg_set in self.package_set:
+                for year in self.package_year:
+                    package_plist = self.loop_feed_locations[pkg_set][year]
+
+                    # If we're only processing from specific files, just do
+                    # the tango for those files, otherwise do the tango for
+                    # everything that is defaulted to.
+                    if self.files_process:
+                        plists = [plist for plist in self.files_process
+                                  if plist in package_plist]
+                    else:
+                        plists = package_plist
+
+                    for plist in plists:
+                        for loop in self.iter_plist(year, plist):
+                            if loop not in seen:
+                                seen.add(loop)
+                                yield loop
+        except (KeyboardInterrupt, SystemExit):
+            self.exit_out()
+
+    def build_master_list(self):
+        """This builds the master list of audio content so it (the master list)
+        can be processed in other functions."""
+        try:
+            for loop in self.iter_loops():
+                self.master_list.append(loop)
         except (KeyboardInterrupt, SystemExit):
             self.exit_out()
 
+    def total_count(self):
+        """Returns the number of loops in the master list for progress output,
+        with a + on the end if more are still being worked out."""
+        if self.planning:
+            return '%s+' % len(self.master_list)
+        else:
+            return str(len(self.master_list))
+
     def convert_size(self, file_size, precision=2):
         """Converts the package file size into a human readable number."""
         try:
@@ -420,8 +913,10 @@ class AppleLoops():
             if not os.path.isdir(folder):
                 try:
                     os.makedirs(folder)
-                except Exception as e:
-                    raise e
+                except OSError as e:
+                    # Another process may have made it in the meantime
+                    if e.errno != errno.EEXIST:
+                        raise e
         except (KeyboardInterrupt, SystemExit):
             self.exit_out()
 
@@ -466,8 +961,8 @@ class AppleLoops():
             for path in glob_path:
                 if self.file_exists(loop, os.path.join(path, loop.pkg_name)):
                     return True
-                else:
-                    return False
+
+            return False
         except (KeyboardInterrupt, SystemExit):
             self.exit_out()
 
@@ -477,21 +972,36 @@ class AppleLoops():
         wrap this in a keyboard/system exit try statement as it could cause
         file writes to go bad."""
         glob_path = glob('%s/*/*/*/' % self.download_location)
-        local_directory = self.local_directory(loop)
-        local_file = os.path.join(local_directory, loop.pkg_name)
+        local_files = [path for path in self.local_files(loop)
+                       if not self.file_exists(loop, path)]
 
         # Test if file exists, then test if the file exists and matches the
         # size it should be, if so, we can copy it.
-        if not self.file_exists(loop, local_file):
+        if local_files:
             for path in glob_path:
                 if self.file_exists(loop, os.path.join(path, loop.pkg_name)):
                     existing_copy = os.path.join(path, loop.pkg_name)
                     if not self.dry_run:
-                        # Make directories otherwise the copy operation fails
-                        self.make_storage_location(local_directory)
-                        shutil.copy2(existing_copy, local_file)
+                        for local_file in local_files:
+                            # Copy to a temporary file first, so a half
+                            # finished copy never looks like a complete package
+                            partial_file = '%s.part' % local_file
+                            try:
+                                # Make directories otherwise the copy
+                                # operation fails
+                                self.make_storage_location(
+                                    os.path.dirname(local_file))
+                                self.copy_file(existing_copy, partial_file)
+                                os.rename(partial_file, local_file)
+                            except (IOError, OSError) as e:
+                                # Carry on with the other locations if a
+                                # mirror can't be written to
+                                if local_file == self.local_files(loop)[0]:
+                                    raise
+                                print 'Could not write to %s: %s' % (
+                                    local_file, e)
                         print 'Copied %s of %s: %s' % (
-                            counter, len(self.master_list), existing_copy
+                            counter, self.total_count(), existing_copy
                         )
                         break
                     else:
@@ -500,18 +1010,164 @@ class AppleLoops():
         else:
             if not self.dry_run:
                     print 'Skipped %s of %s: %s - file exists' % (
-                        counter, len(self.master_list), loop.pkg_name
+                        counter, self.total_count(), loop.pkg_name
                     )
             else:
                 print 'Skip: %s - file exists' % loop.pkg_name
 
+    def copy_file(self, source, destination):
+        """Copies the file along with its permissions and times, like
+        shutil.copy2, but in chunks so held locks are kept refreshed while
+        copying to a slow mirror."""
+        with open(source, 'rb') as reader:
+            with open(destination, 'wb') as writer:
+                while True:
+                    buffer = reader.read(1024 * 1024)
+                    if not buffer:
+                        break
+                    writer.write(buffer)
+                    self.refresh_locks()
+        shutil.copystat(source, destination)
+
+    # Lock a package so other processes using the same download location don't
+    # work on it at the same time
+    def lock_path(self, loop):
+        """Returns the path to the lock file for the loop. Locks are per
+        package name, as the same package can be saved in several folders."""
+        return os.path.join(self.lock_location, '%s.lock' % loop.pkg_name)
+
+    def lock_owner(self, lock_file):
+        """Returns the process ID and host name of the process holding a
+        lock, or None if the lock can't be read."""
+        try:
+            lock = open(lock_file)
+            try:
+                pid, host = lock.read().split()
+            finally:
+                lock.close()
+            return int(pid), host
+        except (IOError, OSError, ValueError):
+            return None
+
+    def lock_is_stale(self, lock_file):
+        """Tests if a lock was left behind by a process that died. That is
+        any lock that hasn't been refreshed within the lease, or one held by a
+        process on this computer that isn't running any more."""
+        try:
+            age = time() - os.path.getmtime(lock_file)
+        except OSError:
+            # Lock was released while we were looking at it
+            return False
+
+        if age > self.lock_lease:
+            return True
+
+        owner = self.lock_owner(lock_file)
+        if owner and owner[1] == socket.gethostname():
+            try:
+                os.kill(owner[0], 0)
+            except OSError as e:
+                return e.errno == errno.ESRCH
+
+        return False
+
+    def acquire_lock(self, loop):
+        """Locks the loop, waiting for any other process that has it locked
+        to finish with it first."""
+        lock_file = self.lock_path(loop)
+        self.make_storage_location(self.lock_location)
+        waiting = False
+        while True:
+            try:
+                lock = os.open(lock_file,
+                               os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise e
+            else:
+                os.write(lock, '%s %s\n' % (os.getpid(), socket.gethostname()))
+                os.close(lock)
+                self.held_locks[loop.pkg_name] = lock_file
+                self.lock_refreshed = time()
+                return
+
+            if self.lock_is_stale(lock_file):
+                print 'Removing stale lock for %s' % loop.pkg_name
+                self.break_lock(lock_file)
+            else:
+                if not waiting:
+                    print 'Waiting for %s - in use by another process' % (
+                        loop.pkg_name
+                    )
+                    waiting = True
+                sleep(self.lock_poll)
+
+    def break_lock(self, lock_file):
+        """Removes a stale lock. Another process may have already removed it
+        and made a fresh lock of its own, so the lock is moved to a name only
+        this process uses and checked again before it is removed. If it turns
+        out to be fresh, it is put back."""
+        taken = '%s.%s.%s' % (lock_file, os.getpid(), socket.gethostname())
+        try:
+            os.rename(lock_file, taken)
+        except OSError:
+            # Someone else has already dealt with it
+            return
+
+        if not self.lock_is_stale(taken):
+            # Link rather than rename back, so a lock made in the meantime
+            # isn't replaced
+            try:
+                os.link(taken, lock_file)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    os.rename(taken, lock_file)
+                    return
+
+        try:
+            os.unlink(taken)
+        except OSError:
+            pass
+
+    def release_lock(self, loop):
+        """Releases the lock on the loop, as long as it is still ours."""
+        lock_file = self.held_locks.pop(loop.pkg_name, None)
+        if lock_file and self.lock_owner(lock_file) == (os.getpid(),
+                                                        socket.gethostname()):
+            try:
+                os.unlink(lock_file)
+            except OSError:
+                pass
+
+    def refresh_locks(self):
+        """Refreshes held locks so other processes can tell this one is still
+        working on them. Cheap enough to call on every read."""
+        if time() - self.lock_refreshed >= self.lock_refresh:
+            for lock_file in self.held_locks.values():
+                try:
+                    os.utime(lock_file, None)
+                except OSError:
+                    pass
+            self.lock_refreshed = time()
+
+    def wait(self, seconds):
+        """Sleeps for the given time, refreshing held locks along the way."""
+        end = time() + seconds
+        while True:
+            self.refresh_locks()
+            remaining = end - time()
+            if remaining <= 0:
+                break
+            sleep(min(remaining, self.lock_refresh))
+
     # Test if loop is mandatory or not, and return the correct local directory
-    def local_directory(self, loop):
+    def local_directory(self, loop, location=None):
         """Just a quick test to see if the loop is optional or mandatory, and
-        return the correct path for either type."""
+        return the correct path for either type. The path is in the download
+        location, unless another location is given."""
         directory_path = (
             os.path.join(
-                self.download_location,
+                location or self.download_location,
                 loop.pkg_plist,  # Trying a different approach to loops
                 # loop.pkg_loop_for,
                 loop.pkg_year,
@@ -522,81 +1178,299 @@ class AppleLoops():
         else:
             return os.path.join(directory_path, 'optional')
 
+    # Opens a request for a loop file, resuming a partial download if the
+    # server supports it
+    def response_validator(self, request):
+        """Returns the ETag of the response, or its Last-Modified date if it
+        doesn't have a strong ETag, to tell versions of a package apart."""
+        etag = request.info().getheader('ETag')
+        if etag and not etag.startswith('W/'):
+            return etag.strip()
+        return request.info().getheader('Last-Modified')
+
+    def open_resume(self, url, offset, validator=None):
+        """Requests the URL, asking for just the bytes from the offset onwards
+        if it isn't 0, as long as the package still matches the validator.
+        Returns the request and the offset to resume writing from, which is 0
+        if the server sent the whole file."""
+        if offset:
+            try:
+                request = self.open_url(url, {'Range': 'bytes=%s-' % offset,
+                                              'If-Range': validator})
+            except urllib2.HTTPError as e:
+                # 416 means the partial file is no use, so start again
+                if e.code != 416:
+                    raise
+                offset = 0
+                request = self.open_url(url)
+            else:
+                content_range = request.info().getheader('Content-Range', '')
+                if (request.getcode() != 206 or
+                        not content_range.startswith('bytes %s-' % offset)):
+                    offset = 0
+                elif self.response_validator(request) != validator:
+                    # The server ignored If-Range, and the package has changed
+                    request.close()
+                    offset = 0
+                    request = self.open_url(url)
+        else:
+            request = self.open_url(url)
+
+        return request, offset
+
+    # Does the transfer for a loop file
+    def transfer(self, url, loop, sinks, counter):
+        """Makes a single attempt at transferring the loop, writing it to each
+        of the sinks as it arrives. Request and read errors are left to the
+        caller to handle, and a transfer that stalls raises StallError. If
+        opening or writing to a mirror fails, it is dropped and the transfer
+        carries on with the rest."""
+        sinks = [sink for sink in sinks if not sink.error]
+
+        # Resume from the point every sink has got to, as long as they all
+        # have part of the same version of the package
+        offset = min(sink.size() for sink in sinks)
+        validators = set(sink.validator() for sink in sinks)
+        validator = validators.pop() if len(validators) == 1 else None
+        if not validator:
+            offset = 0
+        request, offset = self.open_resume(url, offset, validator)
+        validator = self.response_validator(request)
+        bytes_so_far = offset
+        received = 0
+        try:
+            if offset:
+                print 'Resuming %s from %s' % (loop.pkg_name,
+                                               self.convert_size(offset))
+            for sink in list(sinks):
+                try:
+                    sink.open(offset, validator)
+                except (IOError, OSError, DiskSpaceError) as e:
+                    if not self.drop_sink(loop, sinks, sink, e):
+                        raise
+                    sinks.remove(sink)
+
+            # urllib2 doesn't complain if the connection closes early, so
+            # keep track of how much the server said it would send.
+            content_length = request.info().getheader('Content-Length')
+
+            # Throughput over the current stall detection window
+            window_start = time()
+            window_bytes = 0
+
+            # This bit does the download
+            while True:
+                buffer = request.read(8192)
+                if not buffer:
+                    if content_length and received < int(content_length):
+                        raise socket.error('connection closed after %s of %s '
+                                           'bytes' % (received,
+                                                      content_length))
+                    if not self.jss_mode:
+                        print('')
+                    break
+
+                # Re-calculate downloaded bytes
+                bytes_so_far += len(buffer)
+                received += len(buffer)
+
+                # Write out download file to each sink
+                for sink in list(sinks):
+                    try:
+                        sink.write(buffer)
+                    except (IOError, OSError) as e:
+                        if not self.drop_sink(loop, sinks, sink, e):
+                            raise
+                        sinks.remove(sink)
+
+                # Calculate percentage
+                percent = float(bytes_so_far) / float(loop.pkg_size)
+                percent = round(percent*100.0, 2)
+
+                # Some files take up more space locally than remote, so if
+                # percentage exceeds 100%, cap it.
+                if percent >= 100.0:
+                    percent = 100.0
+
+                # Output progress made
+                items_count = '%s of %s' % (counter, self.total_count())
+                if not self.jss_mode:
+                    self.progress_output(loop, percent,
+                                         self.convert_size(float(
+                                             loop.pkg_size)),
+                                         items_count)
+
+                # Let other processes know this download is still going
+                self.refresh_locks()
+
+                # Abort the transfer if it has slowed below the minimum speed
+                window_bytes += len(buffer)
+                elapsed = time() - window_start
+                if elapsed >= self.stall_window:
+                    speed = window_bytes / elapsed
+                    if speed < self.stall_speed:
+                        raise StallError('%s/s for %s seconds' % (
+                            self.convert_size(speed), int(elapsed)))
+                    window_start = time()
+                    window_bytes = 0
+        except:
+            # Finish off the progress line so the retry output is readable
+            if bytes_so_far and not self.jss_mode:
+                print('')
+            raise
+        finally:
+            request.close()
+            for sink in sinks:
+                sink.close()
+
+    # Stop writing to a mirror that has failed
+    def drop_sink(self, loop, sinks, sink, error):
+        """Marks the sink as failed so the download carries on without it.
+        Returns False, leaving the sink alone, if it is the download location
+        or the last sink left, as the error should be raised instead."""
+        live = [other for other in sinks if not other.error]
+        if sink.path == self.local_files(loop)[0] or live == [sink]:
+            return False
+
+        print 'Could not write to %s: %s' % (sink.path, error)
+        sink.error = error
+        sink.close()
+        return True
+
+    # All the places the loop is stored
+    def local_files(self, loop):
+        """Returns the path to the loop in the download location, followed by
+        its path in each of the mirror locations."""
+        return [os.path.join(self.local_directory(loop, location),
+                             loop.pkg_name)
+                for location in [self.download_location] +
+                self.mirror_locations]
+
+    # Check there is enough free space for the download
+    def existing_folder(self, path):
+        """Returns the path, or the closest folder above it that exists."""
+        path = os.path.abspath(path)
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        return path
+
+    def plan_space(self, loop):
+        """Adds the space needed for the loop, if it is missing or incomplete
+        in the download location or any mirrors, to the total needed on each
+        filesystem. Free space on each filesystem is measured the first time
+        it is seen."""
+        try:
+            for location in [self.download_location] + self.mirror_locations:
+                if location not in self.space_devices:
+                    folder = self.existing_folder(location)
+                    device = os.stat(folder).st_dev
+                    self.space_devices[location] = device
+                    if device not in self.space:
+                        filesystem = os.statvfs(folder)
+                        self.space[device] = {
+                            'locations': [],
+                            'free': filesystem.f_bavail * filesystem.f_frsize,
+                            'needed': 0
+                        }
+                    self.space[device]['locations'].append(location)
+
+                path = os.path.join(self.local_directory(loop, location),
+                                    loop.pkg_name)
+                if path in self.space_counted or self.file_exists(loop, path):
+                    continue
+                self.space_counted.add(path)
+
+                # Resumed downloads only need the rest of the file
+                self.space[self.space_devices[location]]['needed'] += max(
+                    0, int(loop.pkg_size) - FileSink(path).size())
+        except (KeyboardInterrupt, SystemExit):
+            self.exit_out()
+
+    def check_space(self, report=False):
+        """Compares the space needed on each filesystem so far with the free
+        space. Raises DiskSpaceError if there isn't enough, except on a dry
+        run. If report is set, or there isn't enough space, the space needed
+        and free is printed."""
+        try:
+            short = []
+            for device, space in self.space.items():
+                if space['needed'] > space['free']:
+                    short.append(', '.join(space['locations']))
+
+                if report or space['needed'] > space['free']:
+                    print 'Space needed in %s: %s (%s free)' % (
+                        ', '.join(space['locations']),
+                        self.convert_size(space['needed']),
+                        self.convert_size(space['free'])
+                    )
+
+            if short and not self.dry_run:
+                raise DiskSpaceError('Not enough space in %s' % (
+                    ', '.join(short)))
+        except (KeyboardInterrupt, SystemExit):
+            self.exit_out()
+
     # Downloads the loop file
     def download(self, loop, counter):
         """Downloads the loop, if the dry run option has been set, then it will
-        only output what it would download, along with the file size."""
+        only output what it would download, along with the file size. If the
+        download fails, the loop is added to the retry queue, unless retrying
+        won't help. Returns True if the loop was (or would be) downloaded."""
         try:
-            local_directory = self.local_directory(loop)
-            local_file = os.path.join(local_directory, loop.pkg_name)
+            local_file = self.local_files(loop)[0]
 
             # Do the download if this isn't a dry run
             if not self.dry_run:
-                # Only create the output directory if this isn't a dry run
-                # Make the download directory
-                self.make_storage_location(local_directory)
-
                 # If the file doesn't already exist, or isn't a complete file,
-                # download it
-                if not self.file_exists(loop, local_file):
+                # download it. The download is written to every location that
+                # is missing the file at the same time, each into a temporary
+                # file that is renamed once complete, so other processes never
+                # see a partial package.
+                sinks = [FileSink(path, int(loop.pkg_size))
+                         for path in self.local_files(loop)
+                         if not self.file_exists(loop, path)]
+
+                # Only create the output directories if this isn't a dry run
+                for sink in sinks:
                     try:
-                        request = self.request_url(loop.pkg_url)
-                    except Exception as e:
-                        raise e
-                    else:
-                        # Open a local file to write into in binary format
-                        local_file = open(local_file, 'wb')
-                        bytes_so_far = 0
-
-                        # This bit does the download
-                        while True:
-                            buffer = request.read(8192)
-                            if not buffer:
-                                if not self.jss_mode:
-                                    print('')
-                                break
-
-                            # Re-calculate downloaded bytes
-                            bytes_so_far += len(buffer)
-
-                            # Write out download file to the loop_file opened
-                            local_file.write(buffer)
-                            # local_file.flush()
-                            os.fsync(local_file)
-
-                            # Calculate percentage
-                            percent = (
-                                float(bytes_so_far) / float(loop.pkg_size)
-                            )
-                            percent = round(percent*100.0, 2)
-
-                            # Some files take up more space locally than
-                            # remote, so if percentage exceeds 100%, cap it.
-                            if percent >= 100.0:
-                                percent = 100.0
-
-                            # Output progress made
-                            items_count = '%s of %s' % (counter,
-                                                        len(self.master_list))
-                            if not self.jss_mode:
-                                self.progress_output(loop, percent,
-                                                     self.convert_size(float(
-                                                         loop.pkg_size)),
-                                                     items_count)
-                    finally:
-                        try:
-                            request.close()
-                            self.download_amount.append(float(loop.pkg_size))
-                        except:
-                            pass
+                        self.make_storage_location(os.path.dirname(sink.path))
+                    except (IOError, OSError) as e:
+                        if not self.drop_sink(loop, sinks, sink, e):
+                            raise
+
+                if sinks:
+                    try:
+                        self.retry_request(self.source_urls(loop),
+                                           self.transfer, loop, sinks,
+                                           counter)
+                    except DownloadError as e:
+                        print 'Failed %s of %s: %s' % (
+                            counter, self.total_count(), e
+                        )
+                        if isinstance(e, PermanentError):
+                            self.failed.append((loop, counter))
                         else:
-                            # Let a random sleep of 1-2 seconds happen between
-                            # each download
-                            pause = uniform(1, 2)
-                            sleep(pause)
+                            self.retry_queue.append((loop, counter))
+                        return False
+                    else:
+                        for sink in sinks:
+                            if sink.error:
+                                continue
+                            try:
+                                sink.commit()
+                            except (IOError, OSError) as e:
+                                if not self.drop_sink(loop, sinks, sink, e):
+                                    raise
+                        self.download_amount.append(float(loop.pkg_size))
+
+                        # Let a random sleep of 1-2 seconds happen between
+                        # each download
+                        pause = uniform(1, 2)
+                        sleep(pause)
+                        return True
                 else:
                     print 'Skipped %s of %s: %s - file exists' % (
-                        counter, len(self.master_list), loop.pkg_name
+                        counter, self.total_count(), loop.pkg_name
                     )
             else:
                 if not self.file_exists(loop, local_file):
@@ -604,42 +1478,151 @@ class AppleLoops():
                         loop.pkg_name, self.convert_size(float(loop.pkg_size))
                     )
                     self.download_amount.append(float(loop.pkg_size))
+                    return True
                 else:
                     print 'Skip: %s - file exists' % loop.pkg_name
+            return False
         except (KeyboardInterrupt, SystemExit):
             self.exit_out()
 
+    # Processes a single loop
+    def process_loop(self, loop, counter):
+        """Copies the loop from a duplicate if there is one, otherwise
+        downloads it. Outside of a dry run the loop is locked while this
+        happens, so another run sharing the download location waits for it
+        and then re-uses the result. Returns True if the loop was
+        downloaded."""
+        if not self.dry_run:
+            self.acquire_lock(loop)
+
+        try:
+            if self.duplicate_file(loop):
+                self.copy_duplicate(loop, counter)
+                return False
+            else:
+                if self.jss_mode:
+                    print 'Downloading %s of %s: %s - %s' % (
+                        counter, self.total_count(), loop.pkg_name,
+                        self.convert_size(float(loop.pkg_size))
+                    )
+                return self.download(loop, counter)
+        finally:
+            if not self.dry_run:
+                self.release_lock(loop)
+
+    # Check there is space for everything before downloading anything
+    def preflight_space(self):
+        """Adds up the space needed for every loop using the sizes in the
+        plists, without asking the server for the size of each package, and
+        raises DiskSpaceError if it won't fit. The totals are then cleared,
+        so they can be worked out again from the real sizes as the loops are
+        planned. The feeds read here are kept for planning, so they aren't
+        fetched twice."""
+        print 'Checking free space'
+        probe_sizes = self.probe_sizes
+        self.probe_sizes = False
+        try:
+            for loop in self.iter_loops():
+                self.plan_space(loop)
+            self.check_space()
+        finally:
+            self.probe_sizes = probe_sizes
+            self.space = collections.OrderedDict()
+            self.space_devices = {}
+            self.space_counted = set()
+
+    # Works out the loops for the main processor
+    def plan(self, queue):
+        """Adds each loop to the master list and the queue as soon as it has
+        been worked out, then puts None on the queue once they're all done.
+        If space is being checked, this stops as soon as the loops worked out
+        so far won't fit, as the real size of a package can be bigger than
+        the plist says. Runs in its own thread, so any error is saved for the
+        main processor to raise."""
+        try:
+            for loop in self.iter_loops():
+                self.master_list.append(loop)
+                if self.space_check:
+                    self.plan_space(loop)
+                    self.check_space()
+                queue.put(loop)
+        except Exception:
+            self.planning_error = sys.exc_info()
+        finally:
+            self.planning = False
+            queue.put(None)
+
     # This is the primary processor for the main function - only used for
     # command line based script usage
     def main_processor(self):
         try:
             """This is the main processor function, it should only be called in the
             main() function - i.e. only for use by the command line."""
-            # Build master list
-            self.build_master_list()
+            # The loops are only worked out a few at a time ahead of the
+            # downloads, so check all of them will fit before starting
+            if self.space_check and not self.dry_run:
+                self.preflight_space()
+
+            # Work out the loops in the background, and download each one as
+            # soon as it is ready
+            queue = Queue.Queue(self.queue_size)
+            self.planning = True
+            planner = threading.Thread(target=self.plan, args=(queue,))
+            planner.daemon = True
+            planner.start()
 
             # Do the download, and supply counter for feedback on progress
             counter = 1
             download_counter = 0
-            for loop in self.master_list:
-                if self.duplicate_file(loop):
-                    self.copy_duplicate(loop, counter)
-                else:
-                    if self.jss_mode:
-                        print 'Downloading %s of %s: %s - %s' % (
-                            counter, len(self.master_list), loop.pkg_name,
-                            self.convert_size(float(loop.pkg_size))
-                        )
-                    self.download(loop, counter)
+            while True:
+                # Use a timeout, otherwise Ctrl-C isn't noticed while waiting
+                try:
+                    loop = queue.get(timeout=1)
+                except Queue.Empty:
+                    continue
+
+                # Stop if working out the loops failed, including if there
+                # isn't going to be enough space for them
+                if self.planning_error:
+                    error = self.planning_error
+                    raise error[0], error[1], error[2]
+                elif loop is None:
+                    break
+
+                if self.process_loop(loop, counter):
                     download_counter += 1
                 counter += 1
 
+            # Packages that failed get one more go at the end of the run, by
+            # which time a transient problem has hopefully passed. Hosts that
+            # are still paused are waited for rather than tried straight away.
+            if self.retry_queue:
+                retry_queue = self.retry_queue
+                self.retry_queue = []
+                print 'Retrying %s failed packages' % len(retry_queue)
+                for loop, counter in retry_queue:
+                    if self.process_loop(loop, counter):
+                        download_counter += 1
+
+            failed = self.failed + self.retry_queue
+            if failed:
+                print 'Failed to download %s packages:' % len(failed)
+                for loop, counter in failed:
+                    print '  %s' % loop.pkg_name
+
+            if self.failed_feeds:
+                print 'Failed to fetch %s feeds:' % len(self.failed_feeds)
+                for plist in self.failed_feeds:
+                    print '  %s' % plist
+
             # Additional information for end of download run
             download_amount = sum(self.download_amount)
 
             if self.dry_run:
+                if self.space_check:
+                    self.check_space(report=True)
                 print '%s packages to process, %s (%s) to download' % (
-                    len(self.master_list), download_counter,
+                    self.total_count(), download_counter,
                     self.convert_size(download_amount)
                 )
             else:
@@ -651,6 +1634,475 @@ class AppleLoops():
             print ''
             sys.exit(0)
 
+    # Warm up a caching server
+    def cache_status(self, request):
+        """Works out if the caching server already had the content, from the
+        response headers. Returns 'hit', 'miss', or 'unknown' if the server
+        doesn't say."""
+        headers = request.info()
+        for header in ['X-Cache', 'X-Cache-Status', 'X-Cache-Lookup']:
+            value = (headers.getheader(header) or '').upper()
+            if 'HIT' in value:
+                return 'hit'
+            elif 'MISS' in value:
+                return 'miss'
+
+        try:
+            if int(headers.getheader('Age')) > 0:
+                return 'hit'
+        except (TypeError, ValueError):
+            pass
+
+        return 'unknown'
+
+    def warm_transfer(self, url, loop):
+        """Makes a single attempt at streaming the loop through the caching
+        server, throwing the content away. Returns the cache status and the
+        size of the package."""
+        request = self.open_url(url)
+        try:
+            status = self.cache_status(request)
+            content_length = request.info().getheader('Content-Length')
+            received = 0
+            while True:
+                buffer = request.read(65536)
+                if not buffer:
+                    break
+                received += len(buffer)
+
+            if content_length and received < int(content_length):
+                raise socket.error('connection closed after %s of %s '
+                                   'bytes' % (received, content_length))
+            return status, received
+        finally:
+            request.close()
+
+    def warm_worker(self, queue, total, results, output_lock):
+        """Takes loops off the queue and warms them until the queue is
+        empty."""
+        while True:
+            try:
+                loop, counter = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            # Don't fall back to Apple's server, that wouldn't warm anything
+            try:
+                status, size = self.retry_request(loop.pkg_url,
+                                                  self.warm_transfer, loop)
+            except DownloadError as e:
+                status = 'failed'
+                self.retry_queue.append((loop, counter))
+                message = 'Failed %s of %s: %s' % (counter, total, e)
+            else:
+                message = 'Warmed %s of %s: %s - %s (%s)' % (
+                    counter, total, loop.pkg_name,
+                    self.convert_size(float(size)), status
+                )
+
+            with output_lock:
+                results[status] = results.get(status, 0) + 1
+                if status != 'failed':
+                    self.download_amount.append(float(size))
+                print message
+
+    def warm_cache(self, threads=8):
+        """Streams every package through the caching server without saving
+        it, so the caching server has the content ready before clients ask
+        for it. Several packages are streamed at once. Reports how many
+        packages the caching server already had, where its response headers
+        say so."""
+        try:
+            # Probing the size would fetch every package through the caching
+            # server before it is warmed, so the size is taken from the warm
+            # response instead
+            self.probe_sizes = False
+            self.build_master_list()
+
+            # The same package can be in more than one feed, but only needs
+            # warming once
+            warm_list = []
+            warm_urls = set()
+            for loop in self.master_list:
+                if loop.pkg_url not in warm_urls:
+                    warm_urls.add(loop.pkg_url)
+                    warm_list.append(loop)
+
+            if self.dry_run:
+                for loop in warm_list:
+                    print 'Warm: %s - %s' % (
+                        loop.pkg_name, self.convert_size(float(loop.pkg_size))
+                    )
+                print '%s packages (%s) to warm' % (
+                    len(warm_list),
+                    self.convert_size(sum(float(loop.pkg_size)
+                                          for loop in warm_list))
+                )
+                return
+
+            queue = Queue.Queue()
+            for counter, loop in enumerate(warm_list, 1):
+                queue.put((loop, counter))
+
+            results = {}
+            output_lock = threading.Lock()
+            workers = []
+            for _ in range(threads):
+                worker = threading.Thread(target=self.warm_worker,
+                                          args=(queue, len(warm_list),
+                                                results, output_lock))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+
+            # Join with a timeout, otherwise Ctrl-C isn't noticed until all
+            # the workers finish
+            while any(worker.is_alive() for worker in workers):
+                for worker in workers:
+                    worker.join(1)
+
+            print 'Warmed %s packages (%s): %s hits, %s misses, %s ' \
+                'unknown, %s failed' % (
+                    len(warm_list) - results.get('failed', 0),
+                    self.convert_size(sum(self.download_amount)),
+                    results.get('hit', 0), results.get('miss', 0),
+                    results.get('unknown', 0), results.get('failed', 0)
+                )
+        except (KeyboardInterrupt, SystemExit):
+            self.exit_out()
+
+    # Verify packages using their xar table of contents
+    def xar_toc(self, data):
+        """Parses the xar header and table of contents (TOC) at the start of a
+        package. Flat packages are xar archives, and the TOC has the checksum
+        of every file in the package, so two packages with the same TOC have
+        the same contents. Returns a dictionary with the compressed TOC, its
+        checksum style and location, and the size the whole package should
+        be. 'length' is how much of the start of the package is needed for
+        all of that, if data is shorter the rest is missing. Raises XarError if
+        data isn't the start of a xar archive."""
+        if len(data) < 28 or data[:4] != 'xar!':
+            raise XarError('not a xar archive')
+
+        (magic, header_size, version, toc_compressed, toc_length,
+         checksum_alg) = struct.unpack('>4sHHQQI', data[:28])
+        heap_start = header_size + toc_compressed
+
+        # Need the rest of the TOC. The TOC checksum is usually right after
+        # it, so ask for enough to include that too.
+        if len(data) < heap_start:
+            return {'length': heap_start + 64}
+
+        try:
+            toc = ElementTree.fromstring(zlib.decompress(
+                data[header_size:heap_start]))
+        except (zlib.error, SyntaxError) as e:
+            raise XarError('could not read the TOC (%s)' % e)
+
+        checksum = toc.find('toc/checksum')
+        if checksum is None:
+            raise XarError('the TOC has no checksum')
+
+        try:
+            checksum_start = heap_start + int(checksum.findtext('offset'))
+            checksum_size = int(checksum.findtext('size'))
+
+            # The package ends with whatever is stored furthest into the heap
+            heap_end = 0
+            for item in toc.iter():
+                offset = item.findtext('offset')
+                length = item.findtext('length') or item.findtext('size')
+                if offset is not None and length is not None:
+                    heap_end = max(heap_end, int(offset) + int(length))
+        except (TypeError, ValueError) as e:
+            raise XarError('could not read the TOC (%s)' % e)
+
+        return {'length': checksum_start + checksum_size,
+                'toc': data[header_size:heap_start],
+                'style': checksum.get('style'),
+                'checksum_start': checksum_start,
+                'checksum_size': checksum_size,
+                'package_size': heap_start + heap_end}
+
+    def read_xar(self, read):
+        """Reads the xar TOC of a package, using read(length) to get the first
+        length bytes of it. The first 4KB usually has all that is needed.
+        Also returns the TOC checksum stored in the package. Raises XarError
+        if the package isn't a xar archive, or is too short."""
+        data = read(4096)
+        while True:
+            toc = self.xar_toc(data)
+            if len(data) >= toc['length']:
+                toc['checksum'] = data[toc['checksum_start']:
+                                       toc['checksum_start'] +
+                                       toc['checksum_size']]
+                return toc
+
+            data = read(toc['length'])
+            if len(data) < toc['length']:
+                raise XarError('package is truncated')
+
+    def fetch_start(self, url, length):
+        """Makes a single request for the first length bytes of the URL. If the
+        server ignores the Range header and sends the whole package, only the
+        bytes needed are read."""
+        request = self.open_url(url, {'Range': 'bytes=0-%s' % (length - 1)})
+        try:
+            data = ''
+            while len(data) < length:
+                buffer = request.read(min(65536, length - len(data)))
+                if not buffer:
+                    break
+                data += buffer
+            return data
+        finally:
+            request.close()
+
+    def verify_package(self, loop, local_file, remote_tocs):
+        """Checks a local package against its xar TOC, and the TOC of the
+        package on the server. Returns a status of 'ok', 'changed' (the
+        package on the server is different), 'corrupt', 'incomplete', or
+        'unverified' (the server's copy couldn't be checked), and a detail
+        message. remote_tocs caches the server's TOC for each URL."""
+        def read_local(length):
+            package = open(local_file, 'rb')
+            try:
+                return package.read(length)
+            finally:
+                package.close()
+
+        try:
+            toc = self.read_xar(read_local)
+            checksum = hashlib.new(toc['style'] or 'sha1', toc['toc'])
+        except XarError as e:
+            return 'corrupt', str(e)
+        except ValueError:
+            return 'unverified', 'unknown checksum style %s' % toc['style']
+
+        if checksum.digest() != toc['checksum']:
+            return 'corrupt', 'TOC checksum does not match'
+
+        local_size = os.path.getsize(local_file)
+        if local_size < toc['package_size']:
+            return 'incomplete', '%s of %s bytes' % (local_size,
+                                                     toc['package_size'])
+        elif local_size > toc['package_size']:
+            return 'corrupt', '%s bytes, expected %s' % (local_size,
+                                                         toc['package_size'])
+
+        # Only the first few KB of the package on the server are needed
+        if loop.pkg_url not in remote_tocs:
+            def read_remote(length):
+                return self.retry_request(self.source_urls(loop),
+                                          self.fetch_start, length)
+
+            try:
+                remote_tocs[loop.pkg_url] = self.read_xar(read_remote)
+            except (DownloadError, XarError) as e:
+                remote_tocs[loop.pkg_url] = e
+
+        remote_toc = remote_tocs[loop.pkg_url]
+        if isinstance(remote_toc, Exception):
+            return 'unverified', str(remote_toc)
+        elif remote_toc['checksum'] != toc['checksum']:
+            return 'changed', 'package on the server is different'
+        else:
+            return 'ok', ''
+
+    def verify(self):
+        """Verifies each package that has been downloaded, in the download
+        location and any mirrors, by its xar TOC. Only the start of each
+        package is read, locally and from the server, rather than
+        downloading or hashing whole packages. Returns the packages that
+        are changed, corrupt, or incomplete."""
+        try:
+            # Sizes come from the TOC, so don't need checking with the server
+            self.probe_sizes = False
+            self.build_master_list()
+
+            results = collections.OrderedDict(
+                (status, 0) for status in ['ok', 'changed', 'corrupt',
+                                           'incomplete', 'unverified'])
+            remote_tocs = {}
+            failed = []
+            for counter, loop in enumerate(self.master_list, 1):
+                for local_file in self.local_files(loop):
+                    if not os.path.exists(local_file):
+                        continue
+
+                    status, detail = self.verify_package(loop, local_file,
+                                                         remote_tocs)
+                    results[status] += 1
+                    if status in ['changed', 'corrupt', 'incomplete']:
+                        failed.append(local_file)
+
+                    if detail:
+                        status = '%s (%s)' % (status, detail)
+                    print 'Verified %s of %s: %s - %s' % (
+                        counter, self.total_count(), local_file, status
+                    )
+
+            print 'Verified %s packages: %s' % (
+                sum(results.values()),
+                ', '.join('%s %s' % (count, status)
+                          for status, count in results.items())
+            )
+            return failed
+        except (KeyboardInterrupt, SystemExit):
+            self.exit_out()
+
+    # Walk the download location
+    def walk_files(self, folder):
+        """Generator that yields the path and stat result of every file in the
+        folder and its subfolders. Symlinks aren't followed."""
+        if scandir:
+            for entry in scandir(folder):
+                if entry.is_dir(follow_symlinks=False):
+                    for item in self.walk_files(entry.path):
+                        yield item
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.path, entry.stat(follow_symlinks=False)
+        else:
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                info = os.lstat(path)
+                if stat.S_ISDIR(info.st_mode):
+                    for item in self.walk_files(path):
+                        yield item
+                elif stat.S_ISREG(info.st_mode):
+                    yield path, info
+
+    def remove_empty_folders(self, folder):
+        """Removes any empty folders under the folder."""
+        for path, folders, files in os.walk(folder, topdown=False):
+            if path != folder and not os.listdir(path):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass
+
+    # Garbage collection of the download location
+    def garbage_collect(self, delete=False, dedupe=False):
+        """Compares what is in the download location with the packages in the
+        current feeds, and reports how much space could be reclaimed from:
+        - superseded packages that no feed refers to any more
+        - partial downloads and locks left behind by runs that died
+        - duplicate copies of the same package in different folders
+        If delete is set, superseded packages and partial downloads are
+        removed. If dedupe is set, duplicate copies are replaced with hard
+        links to a single copy. Nothing is changed on a dry run."""
+        try:
+            # The catalog covers every package set and year, whatever was
+            # asked for on the command line, so content for another app is
+            # never mistaken for superseded content.
+            self.package_set = self.loop_feed_locations.keys()
+            self.package_year = self.loop_years
+            self.mandatory_pkg = False
+            self.optional_pkg = False
+            self.files_process = False
+            self.probe_sizes = False
+            self.build_master_list()
+
+            # Without every feed, packages that are still current would look
+            # superseded
+            if self.failed_feeds:
+                print 'Not every feed could be fetched, skipping garbage ' \
+                    'collection'
+                return
+
+            expected = set(os.path.join(self.local_directory(loop),
+                                        loop.pkg_name)
+                           for loop in self.master_list)
+
+            superseded = []
+            orphaned = []
+            copies = {}
+
+            if os.path.isdir(self.download_location):
+                files = self.walk_files(self.download_location)
+            else:
+                files = []
+
+            for path, info in files:
+                name = os.path.basename(path)
+                if path in expected:
+                    key = (name, info.st_size)
+                    copies.setdefault(key, []).append((path, info))
+                elif os.path.dirname(path) == self.lock_location:
+                    if self.lock_is_stale(path):
+                        orphaned.append((path, info.st_size))
+                elif name.endswith(('.part', '.part.validator')):
+                    lock_file = os.path.join(self.lock_location, '%s.lock' %
+                                             name.rsplit('.part', 1)[0])
+                    if (not os.path.exists(lock_file) or
+                            self.lock_is_stale(lock_file)):
+                        orphaned.append((path, info.st_size))
+                elif name.endswith('.pkg'):
+                    superseded.append((path, info.st_size))
+
+            # Copies of the same package on the same volume can share one
+            # file. Copies that are already hard links don't use any more
+            # space.
+            duplicates = []
+            for key, paths in sorted(copies.items()):
+                keeper_path, keeper = paths[0]
+                for path, info in paths[1:]:
+                    if (info.st_dev == keeper.st_dev and
+                            info.st_ino != keeper.st_ino):
+                        duplicates.append((path, info.st_size, keeper_path))
+
+            categories = [('Superseded packages', superseded),
+                          ('Partial downloads and stale locks', orphaned),
+                          ('Duplicate packages', duplicates)]
+            for category, items in categories:
+                print '%s: %s (%s)' % (
+                    category, len(items),
+                    self.convert_size(sum(item[1] for item in items))
+                )
+                for item in items:
+                    print '  %s' % item[0]
+
+            reclaimable = sum(item[1] for category, items in categories
+                              for item in items)
+            print 'Reclaimable: %s' % self.convert_size(reclaimable)
+
+            if self.dry_run:
+                return
+
+            reclaimed = 0
+            if delete:
+                for path, size in superseded + orphaned:
+                    try:
+                        os.unlink(path)
+                    except OSError as e:
+                        print 'Could not remove %s: %s' % (path, e)
+                    else:
+                        reclaimed += size
+                self.remove_empty_folders(self.download_location)
+
+            if dedupe:
+                for path, size, keeper_path in duplicates:
+                    # Check the contents really are the same before linking,
+                    # and swap the link in atomically.
+                    if not filecmp.cmp(keeper_path, path, shallow=False):
+                        print 'Not linking %s - contents differ from %s' % (
+                            path, keeper_path
+                        )
+                        continue
+                    link_path = '%s.link' % path
+                    try:
+                        os.link(keeper_path, link_path)
+                        os.rename(link_path, path)
+                    except OSError as e:
+                        print 'Could not link %s: %s' % (path, e)
+                    else:
+                        reclaimed += size
+
+            if delete or dedupe:
+                print 'Reclaimed: %s' % self.convert_size(reclaimed)
+        except (KeyboardInterrupt, SystemExit):
+            self.exit_out()
+
 
 def main():
     # Handle keyboard signal interrupt
@@ -714,10 +2166,11 @@ def main():
     parser.add_argument(
         '-d', '--destination',
         type=str,
-        nargs=1,
+        nargs='+',
         dest='destination',
         metavar='<folder>',
-        help='Download location for loops content',
+        help='Download location for loops content, any additional folders '
+             'get a copy of each download',
         required=False
     )
 
@@ -781,6 +2234,26 @@ def main():
         required=False
     )
 
+    # Option for number of retries
+    parser.add_argument(
+        '-r', '--retries',
+        type=int,
+        nargs=1,
+        dest='retries',
+        metavar='<count>',
+        help='Number of times to retry a failed request (default 3)',
+        required=False
+    )
+
+    # Option for warming up a caching server
+    parser.add_argument(
+        '-w', '--warm-cache',
+        action='store_true',
+        dest='warm_cache',
+        help='Stream content through the cache server without saving it',
+        required=False
+    )
+
     # Option for content year
     parser.add_argument(
         '-y', '--content-year',
@@ -792,8 +2265,108 @@ def main():
         required=False
     )
 
+    # Option for verifying downloaded packages
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        dest='verify',
+        help='Check downloaded packages against the packages on the server',
+        required=False
+    )
+
+    # Option for garbage collection
+    parser.add_argument(
+        '--gc',
+        type=str,
+        nargs='*',
+        dest='gc',
+        choices=['delete', 'dedupe'],
+        help='Report space used by superseded, partial, and duplicate '
+             'packages, and optionally delete or dedupe them',
+        required=False
+    )
+
+    # Option for connect timeout
+    parser.add_argument(
+        '--connect-timeout',
+        type=float,
+        nargs=1,
+        dest='connect_timeout',
+        metavar='<seconds>',
+        help='Timeout for connecting to a server (default 30)',
+        required=False
+    )
+
+    # Option for read timeout
+    parser.add_argument(
+        '--read-timeout',
+        type=float,
+        nargs=1,
+        dest='read_timeout',
+        metavar='<seconds>',
+        help='Timeout for each read from a server (default 60)',
+        required=False
+    )
+
+    # Option for retry backoff
+    parser.add_argument(
+        '--retry-backoff',
+        type=float,
+        nargs=1,
+        dest='retry_backoff',
+        metavar='<seconds>',
+        help='Initial delay between retries, doubled on each retry '
+             '(default 2)',
+        required=False
+    )
+
+    # Option for number of downloads at once when warming a caching server
+    parser.add_argument(
+        '--threads',
+        type=int,
+        nargs=1,
+        dest='threads',
+        metavar='<count>',
+        help='Number of packages to warm at once (default 8)',
+        required=False
+    )
+
+    # Option to skip the free space check
+    parser.add_argument(
+        '--skip-space-check',
+        action='store_true',
+        dest='skip_space_check',
+        help='Don\'t check there is enough free space before downloading',
+        required=False
+    )
+
+    # Options for stall detection
+    parser.add_argument(
+        '--stall-speed',
+        type=float,
+        nargs=1,
+        dest='stall_speed',
+        metavar='<KB/s>',
+        help='Abort and retry a download slower than this (default 10)',
+        required=False
+    )
+
+    parser.add_argument(
+        '--stall-window',
+        type=float,
+        nargs=1,
+        dest='stall_window',
+        metavar='<seconds>',
+        help='Time a download is measured over to detect a stall '
+             '(default 60)',
+        required=False
+    )
+
     args = parser.parse_args()
 
+    if args.warm_cache and not args.cache_server:
+        parser.error('--warm-cache needs a cache server, use --cache-server')
+
     # Set which package set to download
     if args.package_set:
         pkg_set = args.package_set
@@ -803,11 +2376,13 @@ def main():
         else:
             pkg_set = ['garageband']
 
-    # Set output directory
-    if args.destination and len(args.destination) is 1:
+    # Set output directory, and any mirrors of it
+    if args.destination:
         store_in = args.destination[0]
+        mirror_to = args.destination[1:]
     else:
         store_in = None
+        mirror_to = None
 
     # Set content year
     if not args.content_year:
@@ -827,6 +2402,38 @@ def main():
     else:
         files_to_process = None
 
+    # Set retry policy
+    if args.retries and len(args.retries) is 1:
+        retries = args.retries[0]
+    else:
+        retries = 3
+
+    if args.retry_backoff and len(args.retry_backoff) is 1:
+        retry_backoff = args.retry_backoff[0]
+    else:
+        retry_backoff = 2
+
+    # Set timeouts and stall detection
+    if args.connect_timeout and len(args.connect_timeout) is 1:
+        connect_timeout = args.connect_timeout[0]
+    else:
+        connect_timeout = 30
+
+    if args.read_timeout and len(args.read_timeout) is 1:
+        read_timeout = args.read_timeout[0]
+    else:
+        read_timeout = 60
+
+    if args.stall_speed and len(args.stall_speed) is 1:
+        stall_speed = args.stall_speed[0] * 1024
+    else:
+        stall_speed = 10240
+
+    if args.stall_window and len(args.stall_window) is 1:
+        stall_window = args.stall_window[0]
+    else:
+        stall_window = 60
+
     # Suppressed mode for JSS output
     if args.jss_quiet_output:
         jss_output_mode = True
@@ -842,12 +2449,41 @@ def main():
                        optional_pkg=args.optional,
                        caching_server=cache_server,
                        files_process=files_to_process,
-                       jss_mode=jss_output_mode)
+                       jss_mode=jss_output_mode,
+                       retries=retries,
+                       retry_backoff=retry_backoff,
+                       connect_timeout=connect_timeout,
+                       read_timeout=read_timeout,
+                       stall_speed=stall_speed,
+                       stall_window=stall_window,
+                       mirror_locations=mirror_to,
+                       space_check=not args.skip_space_check)
+
+    if args.gc is not None:
+        loops.garbage_collect(delete='delete' in args.gc,
+                              dedupe='dedupe' in args.gc)
+    elif args.verify:
+        if loops.verify():
+            return 1
+    elif args.warm_cache:
+        if args.threads and len(args.threads) is 1:
+            loops.warm_cache(threads=args.threads[0])
+        else:
+            loops.warm_cache()
+    else:
+        try:
+            loops.main_processor()
+        except DiskSpaceError as e:
+            print e
+            return 1
 
-    loops.main_processor()
+    # Let the JSS (or whatever else ran this) know that some packages failed
+    if loops.retry_queue or loops.failed or loops.failed_feeds:
+        return 1
 
 if __name__ == '__main__':
     try:
-        main()
+        status = main()
     except (KeyboardInterrupt, SystemExit):
         sys.exit()
+    sys.exit(status)